@@ -20,6 +20,7 @@ import PIL.Image
 import PIL.ImageStat
 import PIL.ImageFilter
 import PIL.ImageOps
+import PIL.ImageChops
 import math
 
 #   Useful constants
@@ -31,6 +32,14 @@ GREENISH_RANGE_MIN_HSV = (60, 40, 35  )              # ***TEMP TEST***
 GREENISH_RANGE_MIN_HSV = (60, 0, 0  )              # ***TEMP TEST***
 GREENISH_RANGE_MAX_HSV = (130, 255, 255)
 
+KEYTABLEMAXSIZE = 1 << 20                           # max entries in a key color table before clearing
+
+#   Key color tables. For each color range, RGB -> mask value.
+#   Screenshots have far fewer distinct colors than pixels, so this
+#   saves most of the HSV conversions, and the tables stay filled
+#   from one image to the next in a long-running process.
+keytables = {}
+
 #   Useful functions
     
 def rgb_to_hsv(r, g, b) :
@@ -94,19 +103,25 @@ def balancegreentingepixel(color, greentingerange) :
     return(r,g,b,128)               # return at half alpha
 
     
-def balancegreentinge(img, edgemask, greentingerange) :
+def balancegreentinge(img, edgemask, greentingerange, offset=(0,0)) :
     '''
     Remove greenish tinge in-place.
+    
+    Edgemask covers the part of img starting at offset.
     '''
     pix = img.load()
     msk = edgemask.load()                # only do areas with nonzero mask
-    (left, top, right, bottom) = img.getbbox()
+    bbox = edgemask.getbbox()
+    if bbox is None :               # no edges, nothing to do
+        return
+    (left, top, right, bottom) = bbox
+    (xoff, yoff) = offset
     for x in range(left, right) :   # apply pixel fix to all pixels
         for y in range(top, bottom) :
             m = msk[x,y]
             if m == 0 :             # skip if not in edge mask
                 continue
-            pix[x,y] = balancegreentingepixel(pix[x,y],greentingerange)
+            pix[x+xoff,y+yoff] = balancegreentingepixel(pix[x+xoff,y+yoff],greentingerange)
             
 def invertwhite(n) :
     '''
@@ -128,36 +143,58 @@ def createedgemask(mask, distance) :
     edgemask.paste(blurmask, mask)                  # edges only
     return edgemask.point(invertwhite)              # blank out interior of image  
     
-def makegreenscreenmask(img, colorrange) :
+def makegreenscreenmask(img, colorrange, box=None) :
     '''
     Make green screen mask. Colorrange is the range of green to be masked.
     Colorrange is in HSV form, but the image is RGB.
+    
+    If box is given, the mask covers only that part of the image.
     '''
     (min_h, min_s, min_v),(max_h, max_s, max_v) = colorrange    # HSV bounds
     pix = img.load()                                    # force into memory
-    width, height = img.size
-    mask = PIL.Image.new("L",img.size,0)                # create matching alpha mask
+    if box is None :
+        box = (0, 0, img.size[0], img.size[1])
+    (xoff, yoff) = box[0:2]
+    width, height = (box[2] - box[0], box[3] - box[1])
+    mask = PIL.Image.new("L",(width, height),0)         # create matching alpha mask
     mpix = mask.load()                                  # force into memory
+    table = keytables.setdefault(colorrange, {})        # RGB -> mask value for this range
+    if len(table) > KEYTABLEMAXSIZE :                   # keep memory bounded
+        table.clear()
     #   Scan for green pixels
     for x in range(width):
         for y in range(height):
-            r, g, b = pix[x, y]
-            h_ratio, s_ratio, v_ratio = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
-            h, s, v = (h_ratio * 360, s_ratio * 255, v_ratio * 255)
-            if min_h <= h <= max_h and min_s <= s <= max_s and min_v <= v <= max_v:
-                v = 0
-            else :
-                v = 255
+            rgb = pix[x+xoff, y+yoff][0:3]
+            v = table.get(rgb)
+            if v is None :                              # new color, classify it
+                r, g, b = rgb
+                h_ratio, s_ratio, v_ratio = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+                h, s, v = (h_ratio * 360, s_ratio * 255, v_ratio * 255)
+                if min_h <= h <= max_h and min_s <= s <= max_s and min_v <= v <= max_v:
+                    v = 0
+                else :
+                    v = 255
+                table[rgb] = v
             mpix[x,y] = v
     return mask    
     
-def cleanmaskouteredge(mask, maxdist) :
+def cleanmaskouteredge(mask, maxdist, box=None) :
     '''
     Remove any nonzero pixels at the outer edge of the mask image.
     
     This cleans up any junk left over by cropping.
+    If box is given, only that part of the mask is cleaned.
     '''
-    (left, top, right, bottom) = mask.getbbox()
+    if box is None :
+        bbox = mask.getbbox()
+        if bbox is None :                               # nothing there
+            return
+        (left, top, right, bottom) = bbox
+    else :
+        bbox = mask.crop(box).getbbox()
+        if bbox is None :                               # nothing there
+            return
+        (left, top, right, bottom) = (bbox[0] + box[0], bbox[1] + box[1], bbox[2] + box[0], bbox[3] + box[1])
     pix = mask.load()                                   # force into memory
     for x in range(left, right) :                       # do top and bottom
         for y in range(top, top+maxdist) :              # clean inward from top
@@ -201,6 +238,81 @@ def removegreenscreen(img, greenrangehsv, greenishrangehsv, maxcleandist, edgeth
     balancegreentinge(maskedimage, edgemask, greenishrangehsv)
     return maskedimage                                  # output is RGBA image                          
 
+def removegreenscreeninplace(img, box, greenrangehsv, greenishrangehsv, maxcleandist, edgethickness) :
+    '''
+    Remove green screen from the part of an RGB image inside box, in place.
+    
+    No cropped copy is made. The image becomes RGBA, transparent outside
+    box and where green was, so the final output can be resampled
+    directly from it. Returns the mask for the area inside box.
+    '''
+    mask = makegreenscreenmask(img, greenrangehsv, box)
+    cleanmaskouteredge(mask, maxcleandist)              # clean up mask outer edge
+    alpha = PIL.Image.new("L",img.size,0)               # transparent outside box
+    alpha.paste(mask, box[0:2])
+    img.putalpha(alpha)                                 # image becomes RGBA
+    edgemask = createedgemask(mask,edgethickness)
+    balancegreentinge(img, edgemask, greenishrangehsv, box[0:2])
+    return mask
+
+
+def hsvrangemask(hsvbands, colorrange) :
+    '''
+    Mask which is 255 where an HSV image is inside colorrange, else 0.
+    
+    Hsvbands is the (H, S, V) bands of the image, from split(), so
+    several ranges can be tested without splitting again.
+    Colorrange is in the same form as for makegreenscreenmask. PIL
+    HSV images have hue in 0..255, not 0..360, rounded down, so each
+    hue level is tested at its midpoint.
+    '''
+    (locolor, hicolor) = colorrange
+    scales = (360.0/255.0, 1.0, 1.0)                    # PIL units to colorrange units
+    offsets = (0.5, 0.0, 0.0)                           # hue level midpoint
+    masks = [hsvbands[c].point([255 if locolor[c] <= (i+offsets[c])*scales[c] <= hicolor[c] else 0 for i in range(256)]) for c in range(3)]
+    return PIL.ImageChops.multiply(PIL.ImageChops.multiply(masks[0], masks[1]), masks[2])
+
+def removegreenscreenbatch(images, greenrangehsv, greenishrangehsv, maxcleandist, edgethickness) :
+    '''
+    Remove green screen from a whole set of RGB images at once.
+    
+    The images are stacked into one image, with transparent gaps
+    between them so edge blurring does not cross from one to the next.
+    Classification and green tinge removal are done with whole-image
+    operations on the stack, instead of pixel by pixel and image by image.
+    
+    Returns list of (RGBA image, bbox), one per input image.
+    '''
+    gap = int(math.ceil(3*edgethickness)) + 1           # beyond reach of edge blur
+    width = max([img.size[0] for img in images])
+    height = sum([img.size[1] for img in images]) + gap*(len(images)-1)
+    stacked = PIL.Image.new("RGB", (width, height))     # all images, one above the other
+    mask = PIL.Image.new("L", (width, height), 0)       # 255 inside images, for now
+    boxes = []
+    y = 0
+    for img in images :
+        box = (0, y, img.size[0], y + img.size[1])
+        stacked.paste(img, box[0:2])
+        mask.paste(255, box)
+        boxes.append(box)
+        y = box[3] + gap
+    #   Classify all pixels at once
+    hsvbands = stacked.convert("HSV").split()           # split once, used for both ranges
+    mask = PIL.ImageChops.subtract(mask, hsvrangemask(hsvbands, greenrangehsv))  # clear where green
+    for box in boxes :                                  # outer edge cleanup is per image
+        cleanmaskouteredge(mask, maxcleandist, box)
+    #   Green tinge removal on edge pixels
+    edgemask = createedgemask(mask, edgethickness)
+    tinge = PIL.ImageChops.multiply(edgemask.point([0] + [255]*255), hsvrangemask(hsvbands, greenishrangehsv))
+    (r, g, b) = [PIL.ImageChops.multiply(band, mask) for band in stacked.split()]  # black where transparent
+    g.paste(PIL.ImageChops.darker(g, PIL.ImageChops.add(r, b, 2.0)), None, tinge)   # make non green
+    mask.paste(128, None, tinge)                        # at half alpha
+    maskedimage = PIL.Image.merge("RGBA", (r, g, b, mask))
+    results = []
+    for box in boxes :
+        img = maskedimage.crop(box)
+        results.append((img, img.getbbox()))
+    return results
                 
 #   Unit test
 
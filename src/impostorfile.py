@@ -19,7 +19,9 @@ import PIL.ImageStat
 import PIL.ImageFilter
 import PIL.ImageOps
 import math
+import io
 import greenscreen
+import scratchstore
 
 #   Useful constants
 GREEN_RANGE_MIN_HSV = (100, 80, 70)                 # green screen range
@@ -30,8 +32,41 @@ GREENISH_RANGE_MIN_HSV = (60, 40, 35  )              # ***TEMP TEST***
 GREENISH_RANGE_MIN_HSV = (60, 0, 0  )              # ***TEMP TEST***
 GREENISH_RANGE_MAX_HSV = (130, 255, 255)
 
+REDLIMITS = ((128,0,0),(255,63,63))                 # color range where red dominates
+
+LANCZOSSUPPORT = 3                                  # LANCZOS filter radius, in output pixels
+
+MAXCLEANDIST = 8                                    # go this far in from edge when cleaning edges
+EDGETHICKNESS = 1.5                                 # range for cleaning out green edge pixels
+
 #   Useful functions
 
+def openimage(image) :
+    '''
+    Open an image given as the bytes of an image file, a PIL image,
+    or an array such as a numpy array. Images and arrays are copied.
+    '''
+    if isinstance(image, (bytes, bytearray, memoryview)) :
+        return PIL.Image.open(io.BytesIO(image))
+    if isinstance(image, PIL.Image.Image) :
+        return image.convert(mode="RGB")
+    return PIL.Image.fromarray(image).convert(mode="RGB")
+
+def resizebox(img, size, box) :
+    '''
+    Same as img.resize(size, LANCZOS, box=box), but only the part of img
+    the filter reads is used. PIL converts a whole RGBA image to
+    premultiplied form before resizing, so this avoids a full-size copy.
+    '''
+    (width, height) = img.size
+    xmargin = int(math.ceil(LANCZOSSUPPORT * max(1.0, (box[2] - box[0]) / size[0]))) + 1
+    ymargin = int(math.ceil(LANCZOSSUPPORT * max(1.0, (box[3] - box[1]) / size[1]))) + 1
+    area = (max(0, int(box[0]) - xmargin), max(0, int(box[1]) - ymargin),
+        min(width, int(math.ceil(box[2])) + xmargin), min(height, int(math.ceil(box[3])) + ymargin))
+    window = img.crop(area)                             # only the area the filter reads
+    return window.resize(size, PIL.Image.LANCZOS, 
+        box=(box[0] - area[0], box[1] - area[1], box[2] - area[0], box[3] - area[1]))
+
 def countrect(rect) :
     count = (1+rect[2]-rect[0]) * (1+rect[3]-rect[1])
 
@@ -104,18 +139,65 @@ class ImpostorFile:
         self.impostor = impostor                        # parent object
         self.filename = filename                        # the filename
         self.inputimg = None                            # input image object
-        self.inputrb = None                             # input image in RGB form
+        self.inputrgb = None                            # input image in RGB form, RGBA after extract
         self.redframe = None                            # rectangle for cropping
-        self.croppedimage = None                        # cropped image without frame
-        self.croppedbbox = None                         # bounding box of useful part of cropped image
+        self.framerect = None                           # area inside frame, in input image
+        self.croppedsize = None                         # size of area inside frame
+        self.croppedbbox = None                         # bounding box of useful part, relative to framerect
+        self.store = None                               # scratch store holding extracted view, if any
+        self.slot = None                                # slot in scratch store
+        self.framesize = None                           # size inside frame, full-size pixels, from check
+        self.keycolor = None                            # green screen color, from check
+        self.scale = 1.0                                # working image size / full image size
+        self.verbose = impostor.options.verbose if impostor is not None else False  # print frame finding progress
         
     def readimage(self) :                               
         '''
         Read image from file
         '''
-        self.inputimg = PIL.Image.open(self.filename)
-        self.inputrgb = self.inputimg.convert(mode="RGB")  # we want to work on this as RGB
+        self.setimage(PIL.Image.open(self.filename))
+        
+    def setimage(self, img) :
+        '''
+        Use an image already in memory, instead of reading the file.
+        
+        The image may be modified by extract.
+        '''
+        self.inputimg = img
+        if self.inputimg.mode == "RGB" :                # already RGB, do not copy
+            self.inputimg.load()
+            self.inputrgb = self.inputimg
+        else :
+            self.inputrgb = self.inputimg.convert(mode="RGB")  # we want to work on this as RGB
         
+    def setextracted(self, img, bbox) :
+        '''
+        Use an RGBA image of the area inside the frame, with green screen
+        already removed, such as one extracted by another process.
+        '''
+        self.inputimg = None
+        self.inputrgb = img
+        self.framerect = (0, 0, img.size[0], img.size[1])
+        self.croppedsize = img.size
+        self.croppedbbox = bbox
+
+    def readthumbnail(self, size) :
+        '''
+        Read a reduced-size image from file, for quick checks.
+        
+        JPEG files are decoded in draft mode, which scales down
+        during decoding and is much faster than a full decode.
+        The result is at least "size" in each dimension.
+        '''
+        self.inputimg = PIL.Image.open(self.filename)
+        fullwidth = self.inputimg.size[0]               # size before draft decode
+        self.inputimg.draft("RGB", size)                # JPEG only, ignored otherwise
+        self.inputrgb = self.inputimg.convert(mode="RGB")
+        if self.inputrgb.size[0] == fullwidth :         # draft did not reduce, do it the slow way
+            factor = max(1, min(self.inputrgb.size[0] // size[0], self.inputrgb.size[1] // size[1]))
+            self.inputrgb = self.inputrgb.reduce(factor)
+        self.scale = self.inputrgb.size[0] / fullwidth  # working scale
+
     def show(self) :                                    
         '''
         Show image for debug purposes
@@ -127,9 +209,14 @@ class ImpostorFile:
         '''
         Find boundaries of a uniform colored frame around the image
         
-        Raises exception if no reasonable frame
+        Returns true if success
         '''
-        pass                                            # ***MORE***
+        (innerrectgood, stddev) = self._findredframerect()
+        if innerrectgood is None :
+            return False                                    # failed   
+        self.framerect = tuple(innerrectgood)
+        self.croppedsize = (self.framerect[2] - self.framerect[0], self.framerect[3] - self.framerect[1])
+        return True
                 
     def sweeph(self, top, bottom, xstart, xend, thickness, colorrange) :
         '''
@@ -192,10 +279,12 @@ class ImpostorFile:
             wrkrect = insetrect(rect, insetdist)                     # far enough in to escape edge noise
             (color, stddev) = self._framestddev(wrkrect, insetrect(wrkrect,1))
             if stddev > maxalloweddev :
-                print("Findgreenscreencolor - could not find uniform green region. Std dev: ", stddev)
+                if self.verbose :
+                    print("Findgreenscreencolor - could not find uniform green region. Std dev: ", stddev)
                 continue
             if not colorinrange(color, greenrange) :
-                print("Findgreenscreencolor - could not find uniform green region. Color: ", color)
+                if self.verbose :
+                    print("Findgreenscreencolor - could not find uniform green region. Color: ", color)
                 continue
             return color
         return None
@@ -212,7 +301,8 @@ class ImpostorFile:
         ycenter = int((top+bottom)/2)                       # center of the image
 
         #   Tighten frame around image
-        print("Tightening from top: ", innerrect)
+        if self.verbose :
+            print("Tightening from top: ", innerrect)
         innerrectgood = list(innerrect)                     # make modifiable
         innerrectwrk = list(innerrectgood)                  # copy, not ref
         stddevgood = 0.0
@@ -223,9 +313,11 @@ class ImpostorFile:
                 break
             innerrectgood[1] = y                            # OK, save
             stddevgood = stddev                             # valid stddev
-        print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
+        if self.verbose :
+            print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
         #   Tighten from bottom
-        print("Tightening from bottom: ", innerrect)
+        if self.verbose :
+            print("Tightening from bottom: ", innerrect)
         innerrectwrk = list(innerrectgood)                  # copy, not ref
         for y in range(innerrectgood[3],ycenter,-1) :
             innerrectwrk[3] = y
@@ -234,9 +326,11 @@ class ImpostorFile:
                 break
             innerrectgood[3] = innerrectwrk[3]              # OK, save
             stddevgood = stddev                             # valid stddev
-        print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
+        if self.verbose :
+            print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
         #   Tighten from left
-        print("Tightening from left: ", innerrectgood)
+        if self.verbose :
+            print("Tightening from left: ", innerrectgood)
         innerrectwrk = list(innerrectgood)                  # copy, not ref
         for x in range(innerrectgood[0],ycenter) :
             innerrectwrk[0] = x
@@ -245,8 +339,9 @@ class ImpostorFile:
                 break
             innerrectgood[0] = innerrectwrk[0]              # OK, save
             stddevgood = stddev                             # valid stddev
-        print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
-        print("Tightening from right: ", innerrectgood)
+        if self.verbose :
+            print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
+            print("Tightening from right: ", innerrectgood)
         innerrectwrk = list(innerrectgood)                  # copy, not ref
         for x in range(innerrectgood[2],ycenter,-1) :
             innerrectwrk[2] = x
@@ -255,19 +350,16 @@ class ImpostorFile:
                 break
             innerrectgood[2] = innerrectwrk[2]              # OK, save
             stddevgood = stddev                             # valid stddev
-        print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
+        if self.verbose :
+            print("Rect: ",innerrectgood, " Stddev: ", stddevgood) # ***TEMP***
         return (innerrectgood, stddevgood)                  # Returns rect
         
-    def _findredframerect(self) :
+    def _sweepframe(self, thickness) :
         '''
-        Find red frame rectangle around image.
+        Sweep in from each side of the image looking for the red frame.
         
-        Returns (rect, stddev) or none.
+        Returns (xleft, ytop, xright, ybot). Any edge not found is None.
         '''
-        MAXALLOWEDDEV = 1.0                                 # max std dev of pixels, units 0..255
-        REDLIMITS = ((128,0,0),(255,63,63))                 # color range where red dominates
-        MINFRAMETHICKNESS = 10
-        
         (width, height) = self.inputrgb.size                # width and height of image
         scantop = int(height/4)                             # scan the middle half of the image
         scanbot = height - int(height/4)
@@ -275,24 +367,40 @@ class ImpostorFile:
         scanright = width - int(width/4)
         xcenter = int((width)/2)
         ycenter = int((height)/2)                           # center of the image
-        xleft = self.sweeph(scantop, scanbot, 0, xcenter, MINFRAMETHICKNESS, REDLIMITS)
-        xright = self.sweeph(scantop, scanbot, width, xcenter, MINFRAMETHICKNESS, REDLIMITS)
-        print("X frame limits: ", xleft, xright)
-        ytop = self.sweepv(scanleft, scanright, 0, ycenter, MINFRAMETHICKNESS, REDLIMITS)
-        ybot = self.sweepv(scanleft, scanright, height, ycenter, MINFRAMETHICKNESS, REDLIMITS)
-        print("Y frame limits: ", ytop, ybot)
+        xleft = self.sweeph(scantop, scanbot, 0, xcenter, thickness, REDLIMITS)
+        xright = self.sweeph(scantop, scanbot, width, xcenter, thickness, REDLIMITS)
+        ytop = self.sweepv(scanleft, scanright, 0, ycenter, thickness, REDLIMITS)
+        ybot = self.sweepv(scanleft, scanright, height, ycenter, thickness, REDLIMITS)
+        if self.verbose :
+            print("X frame limits: ", xleft, xright)
+            print("Y frame limits: ", ytop, ybot)
+        return (xleft, ytop, xright, ybot)
+        
+    def _findredframerect(self) :
+        '''
+        Find red frame rectangle around image.
+        
+        Returns (rect, stddev) or none.
+        '''
+        MAXALLOWEDDEV = 1.0                                 # max std dev of pixels, units 0..255
+        MINFRAMETHICKNESS = 10
+        
+        (xleft, ytop, xright, ybot) = self._sweepframe(MINFRAMETHICKNESS)
         if not (xright is not None and xleft is not None and ytop is not None and ybot is not None) :
-            print("Failed to find frame limits.")
+            if self.verbose :
+                print("Failed to find frame limits.")
             return (None,None)
         # Validate frame
         outerrect = (xleft, ytop, xright, ybot)
         innerrect = insetrect(outerrect, MINFRAMETHICKNESS)
         (color, stddev) = self._framestddev(outerrect, innerrect)
-        print("Frame color: ",color, "Stddev: ",stddev)       
+        if self.verbose :
+            print("Frame color: ",color, "Stddev: ",stddev)       
         if stddev > MAXALLOWEDDEV :
-            print("Frame area is not uniform enough.")
-            croppedrgb = self.inputrgb.crop(outerrect)      # extract rectangle of interest
-            croppedrgb.show()                               # show failed frame
+            if self.verbose :
+                print("Frame area is not uniform enough.")
+                croppedrgb = self.inputrgb.crop(outerrect)  # extract rectangle of interest
+                croppedrgb.show()                           # show failed frame
             return (None,None)
         #   Tighten frame around image
         (innerrectgood, stddev) = self.tightenframe(outerrect, innerrect, MAXALLOWEDDEV)
@@ -364,25 +472,260 @@ class ImpostorFile:
         
         Returns true if success
         '''
-        MAXCLEANDIST = 8                                    # go this far in from edge when cleaning edges
-        EDGETHICKNESS = 1.5                                 # range for cleaning out green edge pixels
-
-        #   Find and crop red frame around image
-        (innerrectgood, stddev) = self._findredframerect()
-        if innerrectgood is None :
+        #   Find red frame around image
+        if not self.findframe() :
             return False                                    # failed   
-        #   Do green screen
-        croppedimage = self.inputrgb.crop(innerrectgood)    # crop out frame
-        ####croppedimage.show()
-        #   crop green in HSV space
+        #   Do green screen, in place. Nothing is cropped until final render.
         greenrangehsv = (GREEN_RANGE_MIN_HSV, GREEN_RANGE_MAX_HSV)
         greenishrangehsv = (GREENISH_RANGE_MIN_HSV, GREENISH_RANGE_MAX_HSV)
-        self.croppedimage = greenscreen.removegreenscreen(croppedimage, greenrangehsv, greenishrangehsv,MAXCLEANDIST, EDGETHICKNESS, False)  # remove green screen
-        self.croppedbbox = self.croppedimage.getbbox()      # useful part of cropped image
-        print("Image size: ",self.croppedimage.size, "  Useful part: ",self.croppedbbox)
-        self.croppedimage.show()                            # ***TEMP***        
-        self.croppedimage.save("/tmp/testmask.png")               # ***TEMP***
-        return True 
+        mask = greenscreen.removegreenscreeninplace(self.inputrgb, self.framerect, greenrangehsv, greenishrangehsv, MAXCLEANDIST, EDGETHICKNESS)  # remove green screen
+        self.croppedbbox = mask.getbbox()                   # useful part inside frame
+        if self.verbose :
+            print("Image size: ",self.croppedsize, "  Useful part: ",self.croppedbbox)
+        return True
+
+    def render(self, croprect, size) :
+        '''
+        Render the area croprect, relative to the frame, at the given size.
 
+        Resamples directly from the input image, which has had its
+        green screen made transparent by extract, or from the
+        scratch store, which holds only the area inside the frame.
+        '''
+        if self.store is not None :                     # extracted view is in scratch store
+            return resizebox(self.store.getimage(self.slot), size, tuple(croprect))
+        (left, top) = self.framerect[0:2]
+        box = (left + croprect[0], top + croprect[1], left + croprect[2], top + croprect[3])
+        (width, height) = self.inputrgb.size
+        if box[0] < 0 or box[1] < 0 or box[2] > width or box[3] > height :   # off the image, crop pads with transparent
+            return self.inputrgb.crop(box).resize(size, PIL.Image.LANCZOS)
+        return resizebox(self.inputrgb, size, box)
         
+    def savetostore(self, store, slot) :
+        '''
+        Save extracted view to a scratch store slot, and release
+        the input image. Render then reads from the store.
+        '''
+        store.put(slot, self.inputrgb.crop(self.framerect), self.croppedbbox)
+        self.usestore(store, slot)
+        
+    def usestore(self, store, slot) :
+        '''
+        Use a view already in a scratch store slot, saved by
+        another process.
+        '''
+        (self.croppedsize, self.croppedbbox) = store.getinfo(slot)
+        self.store = store
+        self.slot = slot
+        self.inputimg = None                            # no longer needed
+        self.inputrgb = None
+        
+    def thumbnailframe(self) :
+        '''
+        Find the frame on a thumbnail read with readthumbnail.
+        
+        Returns (outerrect, innerrect) of the frame, in thumbnail
+        pixels, with innerrect tightened to the inside edge of the
+        frame. Returns None if no frame is found.
+        '''
+        MAXALLOWEDDEV = 1.0                                 # max std dev of frame pixels, as in check
+        thickness = max(2, int(10 * self.scale))            # frame thickness, scaled to thumbnail
+        outerrect = self._sweepframe(thickness)
+        if None in outerrect :
+            return None
+        innerrect = insetrect(outerrect, thickness)
+        if innerrect is None :
+            return None
+        (innerrect, stddev) = self.tightenframe(outerrect, innerrect, MAXALLOWEDDEV)
+        return (outerrect, tuple(innerrect))
+
+    def fullframestddev(self, outerrect, innerrect) :
+        '''
+        Uniformity of a frame found on a thumbnail, measured on the
+        full-size image. Reduction averages away pixel noise, so a
+        noisy frame looks uniform in the thumbnail.
+        
+        Each edge of the frame is pulled in by one thumbnail pixel,
+        so pixels blended with what is next to the frame are not used.
+        
+        Returns stddev, or None if the frame is too thin.
+        '''
+        margin = int(math.ceil(1.0 / self.scale))           # one thumbnail pixel, in full-size pixels
+        outer = insetrect(tuple(int(v / self.scale) for v in outerrect), margin)
+        inner = insetrect(tuple(int(v / self.scale) for v in innerrect), -margin)
+        if outer is None or inner is None :
+            return None
+        full = ImpostorFile(None, self.filename)
+        full.readimage()
+        result = full._framestddev(outer, inner)
+        if result is None :                                 # not properly nested
+            return None
+        return result[1]
 
+    def check(self) :
+        '''
+        Quick pre-flight check of a reduced-size image.
+        
+        Call readthumbnail first. Runs frame detection, frame uniformity,
+        and key color detection, and does not stop at the first problem.
+        Frame uniformity is measured on the full-size image.
+        
+        Returns list of problem strings, empty if OK. If the frame is
+        good, the size inside it, in full-size pixels, is left in
+        self.framesize for the set-level size check.
+        '''
+        MAXALLOWEDDEV = 1.0                                 # max std dev of frame pixels, units 0..255
+        MAXKEYDEV = 8.0                                     # max std dev of key color pixels
+        MINFRAMETHICKNESS = max(2, int(10 * self.scale))    # scaled to working image
+        KEYBAND = 2                                         # thickness of key color sample band
+        
+        problems = []
+        limits = self._sweepframe(MINFRAMETHICKNESS)
+        edgenames = ("left", "top", "right", "bottom")
+        missing = [edgenames[i] for i in range(len(limits)) if limits[i] is None]
+        if missing :
+            problems.append("Frame edge not found: " + ", ".join(missing))
+            return problems                                 # nothing more can be checked
+        outerrect = limits
+        innerrect = insetrect(outerrect, MINFRAMETHICKNESS)
+        if innerrect is None :
+            problems.append("Frame is degenerate: " + str(outerrect))
+            return problems
+        (innerrectgood, stddev) = self.tightenframe(outerrect, innerrect, MAXALLOWEDDEV)
+        if self.scale < 1.0 :                               # thumbnail hides noise, measure full size
+            stddev = self.fullframestddev(outerrect, innerrectgood)
+        else :
+            (color, stddev) = self._framestddev(outerrect, innerrect)
+        if stddev is None :
+            problems.append("Frame is too thin to measure: " + str(outerrect))
+        elif stddev > MAXALLOWEDDEV :
+            problems.append("Frame area is not uniform enough. Stddev: %1.2f" % (stddev,))
+        else :                                              # frame is good, so its size means something
+            self.framesize = (int((innerrectgood[2] - innerrectgood[0]) / self.scale),
+                int((innerrectgood[3] - innerrectgood[1]) / self.scale))   # in full-size pixels
+        #   Key color. Sample a band just inside the frame on each side.
+        #   The object may touch some sides, so one good side is enough.
+        keyrect = insetrect(innerrectgood, 1)
+        bandrect = insetrect(innerrectgood, 1 + KEYBAND)
+        if keyrect is None or bandrect is None :
+            problems.append("Area inside frame is too small: " + str(innerrectgood))
+            return problems
+        sides = [(keyrect[0], keyrect[1], keyrect[2], bandrect[1]),    # top
+            (bandrect[2], keyrect[1], keyrect[2], keyrect[3]),          # right
+            (keyrect[0], bandrect[3], keyrect[2], keyrect[3]),          # bottom
+            (keyrect[0], keyrect[1], bandrect[0], keyrect[3])]          # left
+        greenrangehsv = (GREEN_RANGE_MIN_HSV, GREEN_RANGE_MAX_HSV)
+        keycolors = []
+        for side in sides :
+            (counts, means, stddevs) = self._rectstddev(side)
+            if sum(stddevs) / 3 > MAXKEYDEV :               # not uniform, probably the object
+                continue
+            h_ratio, s_ratio, v_ratio = greenscreen.rgb_to_hsv(means[0] / 255.0, means[1] / 255.0, means[2] / 255.0)
+            if colorinrange((h_ratio * 360, s_ratio * 255, v_ratio * 255), greenrangehsv) :
+                keycolors.append(means)
+        if len(keycolors) == 0 :
+            problems.append("No uniform key color in green screen range inside frame.")
+        else :
+            self.keycolor = tuple(sum([c[i] for c in keycolors]) / len(keycolors) for i in range(3))
+        return problems
+
+def checkfile(filename, thumbnailsize=(128,128)) :
+    '''
+    Pre-flight check of one file, on a thumbnail.
+    
+    Top level function so it can be run in a worker process.
+    
+    Returns (filename, problems, framesize)
+    '''
+    ifile = ImpostorFile(None, filename)
+    ifile.verbose = False                               # quiet, workers run in parallel
+    try :
+        ifile.readthumbnail(thumbnailsize)
+    except (IOError, ValueError) as err :               # unreadable file
+        return (filename, ["Cannot read image: " + str(err)], None)
+    problems = ifile.check()
+    return (filename, problems, ifile.framesize)
+    
+def measureframe(filename, thumbnailsize=(128,128)) :
+    '''
+    Estimate the size inside the frame, in full-size pixels, from a
+    thumbnail. Rounded up by two thumbnail pixels each way, to allow
+    for the thumbnail's coarser edges.
+    
+    Top level function so it can be run in a worker process.
+    
+    Returns (width, height), or None if no frame is found.
+    '''
+    ifile = ImpostorFile(None, filename)
+    ifile.verbose = False                               # quiet, workers run in parallel
+    try :
+        ifile.readthumbnail(thumbnailsize)
+    except (IOError, ValueError) :                      # unreadable, extraction will say so
+        return None
+    rects = ifile.thumbnailframe()
+    if rects is None :
+        return None
+    innerrect = rects[1]
+    return (int(math.ceil((innerrect[2] - innerrect[0] + 2) / ifile.scale)),
+        int(math.ceil((innerrect[3] - innerrect[1] + 2) / ifile.scale)))
+
+def extractfile(filename, storefilename, slot, verbose=False) :
+    '''
+    Read and extract one file, and save the result in a slot
+    of a scratch store. Only the size is returned, not image data.
+    If the area inside the frame is too big for the slot, nothing
+    is saved, and the caller must extract the file itself.
+    
+    Top level function so it can be run in a worker process.
+    
+    Returns size inside the frame, or None if extraction failed.
+    '''
+    ifile = ImpostorFile(None, filename)
+    ifile.verbose = verbose
+    ifile.readimage()
+    if not ifile.extract() :
+        return None
+    store = scratchstore.ScratchStore(storefilename)    # existing file, shared with parent
+    if ifile.croppedsize[0] <= store.slotsize[0] and ifile.croppedsize[1] <= store.slotsize[1] :
+        ifile.savetostore(store, slot)
+    store.close()
+    return ifile.croppedsize
+    
+def extractimage(data) :
+    '''
+    Extract one image, given in any form openimage accepts.
+    
+    Top level function so it can be run in a worker process.
+    
+    Returns (rgbabytes, size, bbox) for the area inside the frame,
+    or None if extraction failed.
+    '''
+    ifile = ImpostorFile(None, "<memory>")
+    ifile.verbose = False
+    ifile.setimage(openimage(data))
+    if not ifile.extract() :
+        return None
+    return (ifile.inputrgb.crop(ifile.framerect).tobytes(), ifile.croppedsize, ifile.croppedbbox)
+    
+def extractbatch(ifiles) :
+    '''
+    Extract a whole set of images, doing green screen removal
+    for all of them at once.
+    
+    Frames are found for all the images first, and if any are not
+    found, nothing more is done.
+    
+    Returns list of indices of images with no frame found, empty if success.
+    '''
+    failed = [i for i in range(len(ifiles)) if not ifiles[i].findframe()]
+    if len(failed) > 0 :
+        return failed
+    greenrangehsv = (GREEN_RANGE_MIN_HSV, GREEN_RANGE_MAX_HSV)
+    greenishrangehsv = (GREENISH_RANGE_MIN_HSV, GREENISH_RANGE_MAX_HSV)
+    results = greenscreen.removegreenscreenbatch([ifile.inputrgb.crop(ifile.framerect) for ifile in ifiles], 
+        greenrangehsv, greenishrangehsv, MAXCLEANDIST, EDGETHICKNESS)
+    for (ifile, (img, bbox)) in zip(ifiles, results) :
+        ifile.setextracted(img, bbox)
+        if ifile.verbose :
+            print("Image size: ",ifile.croppedsize, "  Useful part: ",ifile.croppedbbox)
+    return []
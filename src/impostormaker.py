@@ -20,9 +20,17 @@
 #
 import argparse
 import glob
+import sys
+import os
+import multiprocessing
 import PIL
 import PIL.Image
 import impostorfile
+import scratchstore
+import watchfolder
+import viewselect
+
+MAXALLOWEDSIZEMISMATCH = 0.05                       # allow 5% variation in size inside frame
 
 def stringcommon(a,b) :
     '''
@@ -44,6 +52,35 @@ def stringscommon(lst) :
         return None
     cnt = min([stringcommon(lst[0],s) for s in lst])
     return lst[0][0:cnt]
+    
+def sizemismatches(sizes) :
+    '''
+    Given a list of (width, height) sizes, return the indices of
+    those which are too far below the largest size.
+    '''
+    maxwidth = max([s[0] for s in sizes])
+    maxheight = max([s[1] for s in sizes])
+    return [i for i in range(len(sizes)) if 
+        ((maxwidth - sizes[i][0]) / maxwidth > MAXALLOWEDSIZEMISMATCH or 
+        (maxheight - sizes[i][1]) / maxheight > MAXALLOWEDSIZEMISMATCH)]
+
+def checkproblems(results) :
+    '''
+    Problems for a set of files, given the (filename, problems, framesize)
+    result of checking each one.
+    
+    The size check across the set uses only files with a good frame,
+    so a bad frame is reported against its own file only.
+    
+    Returns list of (filename, problem).
+    '''
+    problems = [(filename, problem) for (filename, fileproblems, framesize) in results for problem in fileproblems]
+    sized = [(filename, framesize) for (filename, fileproblems, framesize) in results if framesize is not None]
+    if len(sized) > 0 :
+        for i in sizemismatches([framesize for (filename, framesize) in sized]) :
+            problems.append((sized[i][0], "Size inside frame %s differs from rest of set by more than %d%%." % 
+                (sized[i][1], int(MAXALLOWEDSIZEMISMATCH*100))))
+    return problems
 
 
 class Impostor :
@@ -51,27 +88,117 @@ class Impostor :
     #   Constructor
     def __init__(self, args) :
         self.options = args
-        print("File args: ", args.files)                # ***TEMP***
+        if args.verbose :
+            print("File args: ", args.files)
         self.filenames = args.files
         self.framesize = (args.width, args.height)      # size of image frame in meters
         self.impostorfiles = []                         # impostor file object
         self.croprect = None                            # cropping rectangle for all images 
         self.sizes = None                               # sizes of all images (pixels) before final crop
+        self.store = None                               # scratch store for extracted images, if any
         
     #   Read in all files
     def readfiles(self) :
         for name in self.filenames :
             ifile = impostorfile.ImpostorFile(self, name)            # object for this input image
-            ifile.readimage()                           # read the image
+            if self.options.scratch is None :           # with scratch store, workers read the images
+                ifile.readimage()                       # read the image
             self.impostorfiles.append(ifile)            # accumulate image objects
             
     def processfiles(self) :
+        if self.options.scratch is not None :           # use worker processes and scratch store
+            return self.processfilesscratch()
+        if self.options.batch :                         # green screen for all files at once
+            failed = impostorfile.extractbatch(self.impostorfiles)
+            for i in failed :
+                print("Could not find frame in ", self.impostorfiles[i].filename)
+            return len(failed) == 0
         for impf in self.impostorfiles :                # for all files
             valid = impf.extract()                      # extract useful part of file
             if not valid :
+                print("Could not find frame in ", impf.filename)
                 return False                            # failed
         return True                                     # success
         
+    def processfilesscratch(self) :
+        '''
+        Extract all files in parallel worker processes.
+        
+        Workers write the extracted images into a memory-mapped
+        scratch file, one slot per file, so no image data is
+        passed back. Slots are sized from the area inside the frame,
+        measured first on thumbnails. A view which still does not fit
+        is extracted here and kept in memory.
+        '''
+        fullsize = (0,0)
+        for name in self.filenames :                    # reads only the image header
+            with PIL.Image.open(name) as img :
+                fullsize = (max(fullsize[0], img.size[0]), max(fullsize[1], img.size[1]))
+        storefilename = os.path.join(self.options.scratch, os.path.basename(self.outfilename()) + ".scratch")
+        with multiprocessing.Pool() as pool :
+            framesizes = [s for s in pool.map(impostorfile.measureframe, self.filenames) if s is not None]
+            if len(framesizes) > 0 :                    # no bigger than the area inside the frame
+                slotsize = (min(fullsize[0], max([s[0] for s in framesizes])), min(fullsize[1], max([s[1] for s in framesizes])))
+            else :                                      # no frames found, extraction will fail anyway
+                slotsize = fullsize
+            self.store = scratchstore.ScratchStore(storefilename, len(self.filenames), slotsize)
+            results = pool.starmap(impostorfile.extractfile, [(self.filenames[i], storefilename, i, self.options.verbose) for i in range(len(self.filenames))])
+        for i in range(len(self.impostorfiles)) :
+            ifile = self.impostorfiles[i]
+            if results[i] is None :
+                print("Could not find frame in ", ifile.filename)
+                return False                            # failed
+            if results[i][0] <= slotsize[0] and results[i][1] <= slotsize[1] :
+                ifile.usestore(self.store, i)
+                continue
+            ifile.readimage()                           # did not fit slot, extract here
+            if not ifile.extract() :
+                return False
+        return True                                     # success
+        
+    def closestore(self) :
+        '''
+        Close and delete scratch file, if any.
+        '''
+        if self.store is not None :
+            self.store.close(remove=True)
+            self.store = None
+        
+    def selectviews(self, faces) :
+        '''
+        Pick "faces" images from a dense turntable capture, using
+        thumbnails. Only the picked images are processed further.
+        '''
+        with multiprocessing.Pool() as pool :
+            hashes = pool.map(viewselect.imagehash, self.filenames)
+        period = viewselect.findperiod(hashes)
+        print("Images in one turn: %d of %d" % (period, len(hashes)))
+        try :
+            selected = viewselect.selectviews(hashes, faces, period)
+        except ValueError as err :
+            print("View selection failed: ", err)
+            return False
+        print("Selected views: ", [self.filenames[i] for i in selected])
+        self.filenames = [self.filenames[i] for i in selected]
+        return True
+        
+    def checkfiles(self) :
+        '''
+        Pre-flight check of all files, using thumbnails.
+        
+        Checks run in parallel, and all problems in all files
+        are reported, not just the first one.
+        
+        Returns true if no problems.
+        '''
+        with multiprocessing.Pool() as pool :
+            results = pool.map(impostorfile.checkfile, self.filenames)
+        problems = checkproblems(results)
+        for (filename, problem) in problems :
+            print("%s: %s" % (filename, problem))
+        print("Checked %d files, %d problems." % (len(self.filenames), len(problems)))
+        return len(problems) == 0
+        
     def outfilename(self, name=None) :
         '''
         Generate output file name
@@ -99,7 +226,8 @@ class Impostor :
         ####reductionratio = (croppedsize[0] / self.sizes[0], croppedsize[1] / self.sizes[1]) # reduced size of cropped version
         ####finalsizeold = (reductionratio[0]*self.framesize[0], reductionratio[1]*self.framesize[1]) # size of actual impostor in meters
         finalsize = (metersperpixel[0]*croppedsize[0], metersperpixel[1]*croppedsize[1])    # size of image after cropping
-        print("Cropped size in pixels: ", croppedsize, "  Frame size (m): ", self.framesize, "  Frame size (px):", self.sizes)    # ***TEMP***
+        if self.options.verbose :
+            print("Cropped size in pixels: ", croppedsize, "  Frame size (m): ", self.framesize, "  Frame size (px):", self.sizes)
         ####print("Old final size: ", finalsizeold, "  New final size: ", finalsize)
         return finalsize
                 
@@ -115,15 +243,13 @@ class Impostor :
         '''
         bboxes = [impf.croppedbbox for impf in self.impostorfiles] # all bboxes
         #   Size check. All cropped images must be close in size
-        MAXALLOWEDSIZEMISMATCH = 0.05                   # allow 5% variation
-        sizes = [impf.croppedimage.size for impf in self.impostorfiles] # all sizes
+        sizes = [impf.croppedsize for impf in self.impostorfiles] # all sizes
+        if len(sizemismatches(sizes)) > 0 :
+            if self.options.verbose :
+                print("Sizes of images inside frame vary too much.")
+            return False
         maxwidth = max([s[0] for s in sizes])
         maxheight = max([s[1] for s in sizes])
-        for s in sizes :
-            if ((maxwidth - s[0]) / maxwidth > MAXALLOWEDSIZEMISMATCH or 
-                (maxheight - s[1]) / maxheight > MAXALLOWEDSIZEMISMATCH) :
-                print("Sizes of images inside frame vary too much.")
-                return False
         self.sizes = (maxwidth, maxheight)              # size info for aspect ratio calc    
         #   Compute initial crop rectangle
         wrect = (min([b[0] for b in bboxes]),
@@ -135,38 +261,132 @@ class Impostor :
         xrightsize = min(maxwidth,wrect[2]-xcenter)
         xhalfsize = max(xleftsize, xrightsize)          # width relative to center
         self.croprect = (xcenter - xhalfsize, wrect[1], xcenter + xhalfsize, wrect[3]) # actual cropping rectangle
-        print("Final cropping rectangle: ",self.croprect)   # ***TEMP***
-        croppedimages = [impf.croppedimage.crop(self.croprect) for impf in self.impostorfiles]    # crop all images
-        self.croppedimages = croppedimages              # save cropped images
-        for img in croppedimages :
-            img.show()                                  # ***TEMP***
+        if self.options.verbose :
+            print("Final cropping rectangle: ",self.croprect)
         return True
         
+    def outputimagesize(self) :
+        '''
+        Size of each image in the output. Width is from the --rez option,
+        height keeps the aspect ratio of the frame.
+        '''
+        rez = self.options.rez
+        return (rez, max(1, int(round(rez * self.framesize[1] / self.framesize[0]))))
+
     def generateimpostor(self, imagesize) :
         '''
         Generate composite impostor image with each image
         adjusted to the indicated size.  Images are stacked
         vertically.
+        
+        Each image is cropped and resized in one step from
+        its input image.
         '''
-        cnt = len(self.croppedimages)                       # number of images to assemble
+        cnt = len(self.impostorfiles)                       # number of images to assemble
         composite = PIL.Image.new("RGBA", (imagesize[0], imagesize[1]*cnt)) # working image
         for n in range(cnt) :                               # for each image 
-            resized = self.croppedimages[n].resize(imagesize,PIL.Image.LANCZOS)  # resize image to fit
+            resized = self.impostorfiles[n].render(self.croprect, imagesize)  # crop and resize image to fit
             composite.paste(resized,(0,imagesize[1]*n))     # add to composite
         return composite                                    # return complete impostor image       
 
+def makeimpostor(images, framesize=(6.0,3.0), imagesize=(128,64), pool=None, batch=False) :
+    '''
+    Make an impostor from images in memory, without reading or
+    writing files.
+    
+    Images can be the bytes of image files, PIL images, or arrays.
+    Framesize is the size of the image frame in meters, and imagesize
+    is the size of each image in the output. If pool, a multiprocessing
+    pool, is given, the images are extracted by its worker processes.
+    If batch is true, green screen is removed from all the images in
+    one pass, as with --batch. Batch cannot be used with a pool.
+    
+    Returns (image, metadata). Raises ValueError if the images cannot be used.
+    '''
+    if len(images) == 0 :
+        raise ValueError("No input images")
+    if len(imagesize) != 2 or imagesize[0] <= 0 or imagesize[1] <= 0 :
+        raise ValueError("Bad output image size: " + str(imagesize))
+    if batch and pool is not None :
+        raise ValueError("Batch green screen removal cannot be used with a worker pool")
+    options = argparse.Namespace(files=[], width=framesize[0], height=framesize[1], 
+        rez=imagesize[0], faces=str(len(images)), form="STAR", 
+        check=False, scratch=None, watch=None, select=False, batch=batch, verbose=False)
+    imp = Impostor(options)
+    imp.filenames = ["<image %d>" % i for i in range(len(images))]
+    failed = []
+    if pool is None :                               # extract here
+        for i in range(len(images)) :
+            ifile = impostorfile.ImpostorFile(imp, imp.filenames[i])
+            ifile.verbose = False                   # nothing to stdout from a library call
+            ifile.setimage(impostorfile.openimage(images[i]))
+            if not batch and not ifile.extract() :
+                failed.append(i)
+            imp.impostorfiles.append(ifile)
+        if batch :
+            failed = impostorfile.extractbatch(imp.impostorfiles)
+    else :                                          # extract in worker processes
+        results = pool.map(impostorfile.extractimage, images)
+        for i in range(len(results)) :
+            ifile = impostorfile.ImpostorFile(imp, imp.filenames[i])
+            if results[i] is None :
+                failed.append(i)
+            else :
+                (data, size, bbox) = results[i]
+                ifile.setextracted(PIL.Image.frombytes("RGBA", size, data), bbox)
+            imp.impostorfiles.append(ifile)
+    if len(failed) > 0 :
+        raise ValueError("Could not find frame in images " + ", ".join([str(i) for i in failed]))
+    if not imp.uniformcrop() :
+        raise ValueError("Sizes of images inside frame vary too much.")
+    image = imp.generateimpostor(imagesize)
+    metadata = {
+        "count": len(images),                       # number of images in impostor
+        "imagesize": tuple(imagesize),              # size of each image in output, pixels
+        "croprect": tuple(imp.croprect),            # crop rectangle, relative to frame
+        "framesizepixels": tuple(imp.sizes),        # size inside frame, pixels
+        "impostorsize": tuple(imp.calcimpostorsize()),  # size of impostor object, meters
+        "bboxes": [impf.croppedbbox for impf in imp.impostorfiles] }
+    return (image, metadata)
+
 def parseargs() :
      #  Parse command line options
      parser = argparse.ArgumentParser(description="Second Life impostor generator")                 # usual argument parser
      parser.add_argument("--width", dest="width", metavar="W", type=float, default=6.0, help="Width of image frame in meters")
      parser.add_argument("--height", dest="height", metavar="H", type=float, default=3.0, help="Width of image frame in meters")
-     parser.add_argument("--rez", dest="rez", metavar="OUTPUTWIDTH", type=int, default=64, help="Width of each output image in pixels.")
+     parser.add_argument("--rez", dest="rez", metavar="OUTPUTWIDTH", type=int, default=128, help="Width of each output image in pixels. Height follows the shape of the frame.")
      parser.add_argument("--faces", dest="faces", metavar="N", default="8", help="Total faces, including top and bottom.")
      parser.add_argument("--form", dest="form", metavar="FORMNAME", default="STAR", help="STAR = N faces in a star pattern. TSTAR: Star plus top and bottom.")
+     parser.add_argument("--select", action="store_true", dest="select", default=False, help="Files are a dense turntable capture, in order. Use only the views closest to the face angles.")
+     parser.add_argument("--batch", action="store_true", dest="batch", default=False, help="Remove green screen from all images in one pass")
+     parser.add_argument("--check", action="store_true", dest="check", default=False, help="Quick check of input files only, no output")
+     parser.add_argument("--scratch", dest="scratch", metavar="DIR", default=None, help="Extract in parallel, keeping images in a scratch file in this directory. The file holds the area inside the frame of every image, about 4 bytes per pixel.")
+     parser.add_argument("--watch", dest="watch", metavar="DIR", default=None, help="Watch this directory and update the impostor as images arrive")
+     parser.add_argument("--unittest", action="store_true", dest="unittest", default=False, help="Run self test and exit")
      parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode")
-     parser.add_argument("files", nargs='+')
+     parser.add_argument("files", nargs='*')
      args = parser.parse_args()
      #  Option validation
+     if args.watch is None and len(args.files) == 0 and not args.unittest :
+         parser.error("No input files")
+     if args.watch is not None and len(args.files) > 0 :
+         parser.error("Input files come from the watched directory, not the command line")
+     if args.batch and args.scratch is not None :
+         parser.error("Use --batch or --scratch, not both")
+     if args.batch and args.check :
+         parser.error("Use --batch or --check, not both")
+     if args.rez <= 0 :
+         parser.error("Output width must be positive: %d" % (args.rez,))
+     if args.watch is not None :
+         for (used, name) in ((args.batch, "--batch"), (args.check, "--check"), (args.select, "--select"), (args.scratch is not None, "--scratch")) :
+             if used :
+                 parser.error("Use %s or --watch, not both" % (name,))
+         if not os.path.isdir(args.watch) :
+             parser.error("Not a directory: " + args.watch)
+     if args.select and args.form != "STAR" :
+         parser.error("View selection is only for STAR form")
+     if args.select and not args.faces.isdigit() :
+         parser.error("Faces must be a number: " + args.faces)
      return args
 
 
@@ -174,26 +394,116 @@ def parseargs() :
 #   Main program
 def main() :
     args = parseargs()                              # parse and check options
+    if args.unittest :                              # self test only
+        return unittest()
     imp = Impostor(args)                            # create main impostor object
+    if args.select :                                # pick views from dense capture
+        if not imp.selectviews(int(args.faces)) :
+            return False
+    if args.check :                                 # check only
+        return imp.checkfiles()
+    if args.watch is not None :                     # watch directory until interrupted
+        watcher = watchfolder.WatchFolder(imp, args.watch, imp.outputimagesize())
+        try :
+            watcher.run()
+        except KeyboardInterrupt :
+            pass
+        return True
     imp.readfiles()                                 # read in all images
     outfile = imp.outfilename()
     print("Will create ",outfile)
-    valid = imp.processfiles()
-    if not valid :
-        print("Process files failed.")
-        return False
-    valid = imp.uniformcrop()
-    if not valid :
-        print("Uniform crop failed.")
-        return False
-    finalimage = imp.generateimpostor((128,64))    # ***TEMP***
+    try :
+        valid = imp.processfiles()
+        if not valid :
+            print("Process files failed.")
+            return False
+        valid = imp.uniformcrop()
+        if not valid :
+            print("Uniform crop failed. Sizes of images inside frame vary too much.")
+            return False
+        finalimage = imp.generateimpostor(imp.outputimagesize())
+    finally :
+        imp.closestore()                            # done with scratch file, even on error
     finalimage.show()
     print("Final impostor size (meters): %1.3f, %1.3f" % imp.calcimpostorsize()) # show final size in meters
     print("Creating ",outfile)
     finalimage.save(outfile)                        # Generate output file
     ####finalimage.save("/tmp/composite.png")           # ***TEMP***
+    return True
+
 
+#   Unit test
 
+def unittest() :
+    '''
+    Self test of the parts which do not need images.
+    
+    Returns true if all tests pass.
+    '''
+    #   Size check, 5% limit. Exactly 5% smaller is allowed.
+    assert sizemismatches([(100,100)]) == []
+    assert sizemismatches([(100,100), (95,100), (100,95)]) == []
+    assert sizemismatches([(100,100), (94,100)]) == [1]
+    assert sizemismatches([(100,100), (100,94), (99,99)]) == [1]
+    assert sizemismatches([(90,100), (100,90), (100,100)]) == [0, 1]
+    #   A bad frame is reported only against its own file
+    results = [("a", [], (100,100)), ("b", ["Frame area is not uniform enough."], None), ("c", [], (99,100))]
+    assert checkproblems(results) == [("b", "Frame area is not uniform enough.")]
+    #   Noisy frame. Thumbnail reduction averages the noise away, so
+    #   the check must still see it at full size.
+    import tempfile
+    import PIL.ImageChops
+    TESTFILE = "../testdata/tableset/glow_005.jpg"
+    assert impostorfile.checkfile(TESTFILE)[1] == []
+    img = PIL.Image.open(TESTFILE).convert("RGB")
+    noise = PIL.Image.effect_noise(img.size, 6).convert("RGB")  # gaussian, centered on 128
+    noisyfile = os.path.join(tempfile.gettempdir(), "impostormaker-noisy.png")
+    PIL.ImageChops.add(img, noise, 1.0, -128).save(noisyfile)
+    try :
+        (filename, problems, framesize) = impostorfile.checkfile(noisyfile)
+    finally :
+        os.remove(noisyfile)
+    assert len(problems) == 1 and problems[0].startswith("Frame area is not uniform enough"), problems
+    assert framesize is None
+    #   In-memory API, on part of the test set
+    import io
+    import contextlib
+    TESTFILES = sorted(glob.glob("../testdata/tableset/*.jpg"))[0:3]
+    BADFILE = "../testdata/greenscreen/girl1.jpg"       # no frame
+    images = []
+    for filename in TESTFILES :
+        with open(filename, "rb") as fd :
+            images.append(fd.read())
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out) :              # library calls print nothing
+        (image, metadata) = makeimpostor(images, imagesize=(64,32))
+        try :
+            with open(BADFILE, "rb") as fd :
+                makeimpostor([images[0], fd.read()])
+            assert False, "makeimpostor should have failed"
+        except ValueError as err :
+            assert str(err).endswith("images 1"), str(err)
+        try :
+            with open(BADFILE, "rb") as fd :
+                makeimpostor([images[0], fd.read()], batch=True)
+            assert False, "makeimpostor should have failed"
+        except ValueError as err :
+            assert str(err).endswith("images 1"), str(err)
+        (batchimage, metadata) = makeimpostor(images, imagesize=(64,32), batch=True)
+        assert batchimage.size == image.size
+    assert out.getvalue() == "", out.getvalue()
+    assert image.size == (64, 32*len(images)) and image.mode == "RGBA"
+    assert metadata["count"] == len(images) and len(metadata["bboxes"]) == len(images)
+    assert image.getbbox() is not None                  # something was drawn
+    for badsize in ((64,), (0,0)) :
+        try :
+            makeimpostor(images, imagesize=badsize)
+            assert False, "makeimpostor should have failed"
+        except ValueError :
+            pass
+    print("Test complete.")
+    return True
      
 #   Run program
-main()
+if __name__ == "__main__" :                         # not when imported by worker processes
+    sys.exit(0 if main() else 1)                    # nonzero status on failure or problems found
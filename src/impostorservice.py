@@ -0,0 +1,266 @@
+#
+#   impostorservice.py - part of impostormaker
+#
+#   Long-running local impostor service
+#
+#   Keeps a pool of worker processes, with their imports done and their
+#   key color tables filled, so that many small jobs can be submitted
+#   without paying process startup for each one. Listens on a local
+#   TCP port or a Unix socket.
+#
+#   Requests:
+#
+#       POST /impostor
+#           Body is JSON:
+#               {"images": [base64 image file, ...],
+#                "width": frame width (m), "height": frame height (m),
+#                "imagesize": [width, height] of each output image}
+#           Reply is JSON:
+#               {"image": base64 PNG, "metadata": {...}}
+#
+#       GET /status
+#           Reply is JSON with the number of jobs running and waiting.
+#
+#   Jobs beyond the concurrency limit wait their turn. If too many
+#   are waiting, the request is refused with 503.
+#
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import socketserver
+import threading
+import http.server
+import impostormaker
+
+#   Useful constants
+MAXREQUESTBYTES = 256*1024*1024                     # largest request body accepted
+
+class ServiceBusy(Exception) :
+    '''
+    Too many jobs waiting
+    '''
+    pass
+
+class ImpostorService :
+
+    '''
+    Worker pool and job limits, shared by all request handlers
+    '''
+
+    def __init__(self, workers, maxjobs, maxqueue) :
+        self.pool = multiprocessing.Pool(workers)       # warm worker processes
+        self.workers = workers
+        self.maxjobs = maxjobs                          # jobs running at once
+        self.maxqueue = maxqueue                        # jobs waiting to run
+        self.slots = threading.BoundedSemaphore(maxjobs)
+        self.lock = threading.Lock()                    # protects counts
+        self.running = 0
+        self.waiting = 0
+
+    def submit(self, images, framesize, imagesize) :
+        '''
+        Run one job, waiting for a free slot if necessary.
+
+        Returns (image, metadata). Raises ServiceBusy if too many jobs
+        are waiting, ValueError if the images cannot be used.
+        '''
+        if not self.slots.acquire(blocking=False) :     # no free slot, join queue
+            with self.lock :
+                if self.waiting >= self.maxqueue :
+                    raise ServiceBusy("Too many jobs waiting: %d" % (self.waiting,))
+                self.waiting += 1
+            self.slots.acquire()                        # wait our turn
+            with self.lock :
+                self.waiting -= 1
+        with self.lock :
+            self.running += 1
+        try :
+            return impostormaker.makeimpostor(images, framesize, imagesize, pool=self.pool)
+        finally :
+            with self.lock :
+                self.running -= 1
+            self.slots.release()
+
+    def status(self) :
+        '''
+        Current load, as a dict
+        '''
+        with self.lock :
+            return {"workers": self.workers, "maxjobs": self.maxjobs, "maxqueue": self.maxqueue,
+                "running": self.running, "waiting": self.waiting}
+
+    def close(self) :
+        self.pool.close()
+        self.pool.join()
+
+class ImpostorRequestHandler(http.server.BaseHTTPRequestHandler) :
+
+    '''
+    HTTP requests for the service
+    '''
+
+    def address_string(self) :
+        if isinstance(self.client_address, tuple) :     # TCP
+            return self.client_address[0]
+        return "local"                                  # Unix socket has no address
+
+    def sendjson(self, code, reply) :
+        '''
+        Send a JSON reply
+        '''
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) :
+        if self.path != "/status" :
+            self.sendjson(404, {"error": "Not found: " + self.path})
+            return
+        self.sendjson(200, self.server.service.status())
+
+    def do_POST(self) :
+        if self.path != "/impostor" :
+            self.sendjson(404, {"error": "Not found: " + self.path})
+            return
+        try :
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError :
+            self.sendjson(400, {"error": "Bad Content-Length: " + self.headers.get("Content-Length")})
+            return
+        if length <= 0 :
+            self.sendjson(411, {"error": "Request body required"})
+            return
+        if length > MAXREQUESTBYTES :
+            self.sendjson(413, {"error": "Request too large: %d" % (length,)})
+            return
+        try :
+            request = json.loads(self.rfile.read(length))
+            images = [base64.b64decode(s) for s in request["images"]]
+            framesize = (float(request.get("width", 6.0)), float(request.get("height", 3.0)))
+            imagesize = request.get("imagesize", (128,64))
+            if (not isinstance(imagesize, (list, tuple)) or len(imagesize) != 2 or
+                not all(isinstance(n, int) and not isinstance(n, bool) and n > 0 for n in imagesize)) :
+                raise ValueError("imagesize must be two positive integers: " + json.dumps(imagesize))
+            imagesize = tuple(imagesize)
+            if framesize[0] <= 0 or framesize[1] <= 0 :
+                raise ValueError("width and height must be positive")
+        except (ValueError, KeyError, TypeError) as err :
+            self.sendjson(400, {"error": "Bad request: " + str(err)})
+            return
+        try :
+            (image, metadata) = self.server.service.submit(images, framesize, imagesize)
+        except ServiceBusy as err :
+            self.sendjson(503, {"error": str(err)})
+            return
+        except (ValueError, IOError) as err :           # unusable images
+            self.sendjson(422, {"error": str(err)})
+            return
+        except Exception as err :                       # our bug, but the client still gets an answer
+            self.sendjson(500, {"error": "Internal error: " + str(err)})
+            return
+        fd = io.BytesIO()
+        image.save(fd, format="PNG")
+        self.sendjson(200, {"image": base64.b64encode(fd.getvalue()).decode("ascii"), "metadata": metadata})
+
+class ImpostorTCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer) :
+    daemon_threads = True
+
+class ImpostorUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer) :
+    daemon_threads = True
+
+def parseargs() :
+     #  Parse command line options
+     parser = argparse.ArgumentParser(description="Second Life impostor generator service")
+     parser.add_argument("--port", dest="port", metavar="PORT", type=int, default=8765, help="Local TCP port to listen on")
+     parser.add_argument("--socket", dest="socket", metavar="PATH", default=None, help="Listen on this Unix socket instead of a TCP port")
+     parser.add_argument("--workers", dest="workers", metavar="N", type=int, default=os.cpu_count(), help="Number of worker processes")
+     parser.add_argument("--maxjobs", dest="maxjobs", metavar="N", type=int, default=4, help="Jobs running at once")
+     parser.add_argument("--maxqueue", dest="maxqueue", metavar="N", type=int, default=100, help="Jobs waiting before requests are refused")
+     parser.add_argument("--unittest", action="store_true", dest="unittest", default=False, help="Run self test and exit")
+     args = parser.parse_args()
+     return args
+
+#   Main program
+def main() :
+    args = parseargs()
+    if args.unittest :                              # self test only
+        return unittest()
+    service = ImpostorService(args.workers, args.maxjobs, args.maxqueue)
+    if args.socket is not None :
+        if os.path.exists(args.socket) :                # left over from previous run
+            os.remove(args.socket)
+        server = ImpostorUnixServer(args.socket, ImpostorRequestHandler)
+        print("Listening on ", args.socket)
+    else :
+        server = ImpostorTCPServer(("127.0.0.1", args.port), ImpostorRequestHandler)
+        print("Listening on port ", args.port)
+    server.service = service
+    try :
+        server.serve_forever()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        server.server_close()
+        service.close()
+        if args.socket is not None :
+            os.remove(args.socket)
+
+#   Unit test
+
+def unittest() :
+    '''
+    Run a service on a free local port and send it good and bad requests.
+    
+    Returns true if all tests pass.
+    '''
+    import glob
+    import http.client
+    TESTFILES = sorted(glob.glob("../testdata/tableset/*.jpg"))[0:2]
+    images = []
+    for filename in TESTFILES :
+        with open(filename, "rb") as fd :
+            images.append(base64.b64encode(fd.read()).decode("ascii"))
+    service = ImpostorService(1, 1, 0)
+    server = ImpostorTCPServer(("127.0.0.1", 0), ImpostorRequestHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    def post(body, length=None) :
+        '''
+        POST to /impostor, returning (status, reply)
+        '''
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.putrequest("POST", "/impostor")
+        conn.putheader("Content-Length", str(len(body)) if length is None else length)
+        conn.endheaders()
+        conn.send(body)
+        response = conn.getresponse()
+        reply = json.loads(response.read())
+        conn.close()
+        return (response.status, reply)
+    try :
+        assert post(b"", "abc")[0] == 400                   # bad length
+        assert post(b"")[0] == 411                          # no body
+        assert post(b"not json")[0] == 400
+        for imagesize in ([64], [0,0], [64,"a"]) :
+            assert post(json.dumps({"images": images, "imagesize": imagesize}).encode("utf-8"))[0] == 400, imagesize
+        assert post(json.dumps({"images": [base64.b64encode(b"junk").decode("ascii")]}).encode("utf-8"))[0] == 422
+        (status, reply) = post(json.dumps({"images": images, "imagesize": [64,32]}).encode("utf-8"))
+        assert status == 200, reply
+        assert reply["metadata"]["count"] == len(images) and reply["metadata"]["imagesize"] == [64,32]
+    finally :
+        server.shutdown()
+        server.server_close()
+        service.close()
+    print("Test complete.")
+    return True
+
+#   Run program
+if __name__ == "__main__" :
+    main()
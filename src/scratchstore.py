@@ -0,0 +1,166 @@
+#
+#   scratchstore.py - part of impostormaker
+#
+#   Memory-mapped scratch storage for extracted views
+#
+#   Each view of a set, after frame and green screen removal, is
+#   written into a fixed-size slot of one memory-mapped file, along
+#   with its size and bounding box. Worker processes write the slots,
+#   and the parent reads back only the parts it needs, without copying
+#   and without passing image data between processes.
+#
+#   File layout:
+#       File header, HEADERSIZE bytes
+#       Slot 0 header, HEADERSIZE bytes, then slot 0 RGBA pixels
+#       Slot 1 ...
+#
+#   Slot pixels are slotwidth * slotheight * 4 bytes. A view smaller
+#   than the slot is stored at the upper left and the rest of the slot
+#   is transparent.
+#
+import os
+import mmap
+import struct
+import PIL
+import PIL.Image
+
+#   Useful constants
+MAGIC = b"IMPSCRT1"                                 # file type identifier
+HEADERSIZE = 64                                     # file and slot header size, bytes
+FILEHEADER = "<8sIII"                               # magic, count, slotwidth, slotheight
+SLOTHEADER = "<IIIIiiii"                            # valid, width, height, hasbbox, bbox
+BYTESPERPIXEL = 4                                   # RGBA
+
+class ScratchStore :
+
+    '''
+    One memory-mapped file holding all the views of a set
+    '''
+
+    def __init__(self, filename, count=None, slotsize=None) :
+        '''
+        Open a scratch file. If count and slotsize are given, create it
+        with "count" empty slots, each big enough for an image of slotsize.
+        '''
+        self.filename = filename
+        if count is not None :                          # create new file
+            (slotwidth, slotheight) = slotsize
+            self.count = count
+            self.slotsize = (slotwidth, slotheight)
+            with open(filename, "wb") as fd :
+                fd.write(struct.pack(FILEHEADER, MAGIC, count, slotwidth, slotheight).ljust(HEADERSIZE, b"\0"))
+                fd.truncate(HEADERSIZE + count * self._slotbytes())   # zero filled, so all transparent
+        self.fd = open(filename, "r+b")
+        self.mm = mmap.mmap(self.fd.fileno(), 0)
+        (magic, count, slotwidth, slotheight) = struct.unpack_from(FILEHEADER, self.mm, 0)
+        if magic != MAGIC :
+            raise ValueError("Not an impostor scratch file: " + filename)
+        self.count = count
+        self.slotsize = (slotwidth, slotheight)
+
+    def _slotbytes(self) :
+        '''
+        Size of one slot, header plus pixels
+        '''
+        return HEADERSIZE + self.slotsize[0] * self.slotsize[1] * BYTESPERPIXEL
+
+    def _slotoffset(self, slot) :
+        '''
+        Offset of slot header in file
+        '''
+        if slot < 0 or slot >= self.count :
+            raise IndexError("Scratch slot %d out of range 0..%d" % (slot, self.count-1))
+        return HEADERSIZE + slot * self._slotbytes()
+
+    def put(self, slot, img, bbox) :
+        '''
+        Write an RGBA image and its bounding box into a slot.
+        '''
+        (width, height) = img.size
+        (slotwidth, slotheight) = self.slotsize
+        if img.mode != "RGBA" or width > slotwidth or height > slotheight :
+            raise ValueError("Image %s %s does not fit scratch slot %s" % (img.mode, img.size, self.slotsize))
+        offset = self._slotoffset(slot)
+        data = img.tobytes()
+        rowbytes = width * BYTESPERPIXEL
+        slotrowbytes = slotwidth * BYTESPERPIXEL
+        pixoffset = offset + HEADERSIZE
+        for y in range(height) :                        # rows are shorter than slot rows
+            self.mm[pixoffset + y*slotrowbytes : pixoffset + y*slotrowbytes + rowbytes] = data[y*rowbytes : (y+1)*rowbytes]
+        if bbox is None :
+            struct.pack_into(SLOTHEADER, self.mm, offset, 1, width, height, 0, 0, 0, 0, 0)
+        else :
+            struct.pack_into(SLOTHEADER, self.mm, offset, 1, width, height, 1, *bbox)
+
+    def getinfo(self, slot) :
+        '''
+        Returns (size, bbox) for a slot, or None if the slot is empty.
+        '''
+        (valid, width, height, hasbbox, left, top, right, bottom) = struct.unpack_from(SLOTHEADER, self.mm, self._slotoffset(slot))
+        if not valid :
+            return None
+        bbox = (left, top, right, bottom) if hasbbox else None
+        return ((width, height), bbox)
+
+    def getimage(self, slot) :
+        '''
+        Image for the whole slot, sharing memory with the file.
+
+        The image is slot size, transparent outside the stored view,
+        and must not be modified.
+        '''
+        offset = self._slotoffset(slot) + HEADERSIZE
+        buf = memoryview(self.mm)[offset : offset + self._slotbytes() - HEADERSIZE]
+        return PIL.Image.frombuffer("RGBA", self.slotsize, buf, "raw", "RGBA", 0, 1)
+
+    def close(self, remove=False) :
+        '''
+        Close, and optionally delete, the scratch file.
+        '''
+        try :
+            self.mm.close()
+        except BufferError :                            # images still using it, let them keep it
+            pass
+        self.fd.close()
+        if remove :
+            os.remove(self.filename)
+
+#   Unit test
+
+def unittest() :
+    import tempfile
+    filename = os.path.join(tempfile.gettempdir(), "scratchstore-test.scratch")
+    store = ScratchStore(filename, 3, (10, 8))
+    assert store.getinfo(0) is None                     # empty slot
+    #   Short, narrow image in a larger slot
+    img = PIL.Image.new("RGBA", (6, 5), (0, 0, 0, 0))
+    img.paste((10, 20, 30, 255), (1, 2, 4, 5))
+    store.put(1, img, img.getbbox())
+    assert store.getinfo(1) == ((6, 5), (1, 2, 4, 5))
+    slotimg = store.getimage(1)
+    assert slotimg.size == (10, 8)
+    assert slotimg.crop((0, 0, 6, 5)).tobytes() == img.tobytes()        # round trip
+    assert slotimg.getpixel((7, 3)) == (0, 0, 0, 0)     # outside stored image is transparent
+    assert slotimg.getpixel((2, 6)) == (0, 0, 0, 0)
+    #   Full slot, no bbox, then reopen from another handle
+    full = PIL.Image.new("RGBA", (10, 8), (1, 2, 3, 4))
+    store.put(2, full, None)
+    other = ScratchStore(filename)                      # as a worker would
+    assert other.count == 3 and other.slotsize == (10, 8)
+    assert other.getinfo(2) == ((10, 8), None)
+    assert other.getimage(2).tobytes() == full.tobytes()
+    #   Too big, or out of range
+    for (slot, badimg) in ((0, PIL.Image.new("RGBA", (11, 8))), (0, PIL.Image.new("RGB", (4, 4))), (3, full)) :
+        try :
+            store.put(slot, badimg, None)
+            assert False, "put should have failed"
+        except (ValueError, IndexError) :
+            pass
+    other.close()
+    store.close(remove=True)
+    assert not os.path.exists(filename)
+    print("Test complete.")
+
+
+if __name__ == "__main__" :                             # if running standalone
+    unittest()
@@ -0,0 +1,177 @@
+#
+#   viewselect.py - part of impostormaker
+#
+#   Pick views from a dense turntable capture
+#
+#   A capture may have many more images than the impostor has faces,
+#   for example 72 images for an 8-face STAR. Each image gets a cheap
+#   perceptual hash of the object, from a draft-decoded thumbnail. The
+#   hashes are used only to find how many images make one full turn,
+#   for captures that overshoot and come back around to the start.
+#   Evenly spaced images within that turn are picked, and only those
+#   need full-size processing.
+#
+#   No angle is estimated for each image. Selection is index arithmetic,
+#   which assumes the images are in capture order, one turn starting at
+#   the first image, at a steady rotation rate. An uneven turntable gives
+#   unevenly spaced views.
+#
+import PIL
+import PIL.Image
+import impostorfile
+import greenscreen
+
+#   Useful constants
+HASHSIZE = (17, 16)                                 # difference hash of 16x16 = 256 bits
+MINTURNFRACTION = 0.75                              # a full turn is at least this fraction of the images
+WRAPMATCHFRACTION = 0.5                             # images one turn apart differ this much less than neighbors
+MINWRAPPAIRS = 3                                    # need this many image pairs one turn apart to trust a period
+
+def objectrect(ifile) :
+    '''
+    Bounding box of the object in a thumbnail: inside the red frame,
+    and not key color.
+
+    Returns rect, or None if the frame or object cannot be found.
+    '''
+    rects = ifile.thumbnailframe()
+    if rects is None :
+        return None
+    innerrect = impostorfile.insetrect(rects[1], 1)     # clear of frame edge
+    if innerrect is None :
+        return None
+    greenrangehsv = (impostorfile.GREEN_RANGE_MIN_HSV, impostorfile.GREEN_RANGE_MAX_HSV)
+    bbox = greenscreen.makegreenscreenmask(ifile.inputrgb, greenrangehsv, innerrect).getbbox()
+    if bbox is None :                               # all key color, nothing there
+        return None
+    return (bbox[0] + innerrect[0], bbox[1] + innerrect[1], bbox[2] + innerrect[0], bbox[3] + innerrect[1])
+
+def imagehash(filename, thumbnailsize=(128,128)) :
+    '''
+    Difference hash of the object in an image, computed from a thumbnail.
+    If the frame or object cannot be found, the middle of the image is
+    used instead.
+
+    Top level function so it can be run in a worker process.
+
+    Returns the hash as an integer.
+    '''
+    ifile = impostorfile.ImpostorFile(None, filename)
+    ifile.verbose = False                           # quiet, workers run in parallel
+    ifile.readthumbnail(thumbnailsize)
+    rect = objectrect(ifile)
+    if rect is None :                               # use the middle
+        (width, height) = ifile.inputrgb.size
+        rect = (int(width/4), int(height/4), width - int(width/4), height - int(height/4))
+    small = ifile.inputrgb.crop(rect).convert("L").resize(HASHSIZE, PIL.Image.BILINEAR)
+    pix = small.load()
+    bits = 0
+    for y in range(HASHSIZE[1]) :
+        for x in range(HASHSIZE[0]-1) :                 # compare each pixel with its right neighbor
+            bits = (bits << 1) | (1 if pix[x,y] < pix[x+1,y] else 0)
+    return bits
+
+def hashdistance(a, b) :
+    '''
+    Number of bits different between two hashes
+    '''
+    return bin(a ^ b).count("1")
+
+def meandistance(hashes, step) :
+    '''
+    Average hash distance between images "step" apart
+    '''
+    pairs = [(hashes[i], hashes[i+step]) for i in range(len(hashes) - step)]
+    return sum([hashdistance(a, b) for (a, b) in pairs]) / len(pairs)
+
+def findperiod(hashes) :
+    '''
+    Number of images in one full turn.
+
+    If the images from some point on look like the images from the
+    start, much more so than neighboring images look like each other,
+    the turn has come back to the start there. Otherwise the images
+    are taken to be exactly one turn.
+
+    A period is only considered if there are at least MINWRAPPAIRS
+    pairs of images one period apart, so a match between the last
+    image or two and the first ones is not enough.
+
+    An object with rotational symmetry, such as a square table, looks
+    the same after part of a turn, so images match at several offsets
+    and a wrap cannot be told from the symmetry. Unless exactly one
+    offset matches, the images are taken to be exactly one turn.
+    '''
+    cnt = len(hashes)
+    if cnt < 3 :
+        return cnt
+    stepdist = meandistance(hashes, 1)                  # difference for one step of rotation
+    first = max(2, int(cnt * MINTURNFRACTION))
+    matches = [period for period in range(2, cnt - MINWRAPPAIRS + 1) 
+        if meandistance(hashes, period) <= stepdist * WRAPMATCHFRACTION]
+    if len(matches) == 1 and matches[0] >= first :      # back at the start, and nowhere else
+        return matches[0]
+    return cnt
+
+def selectviews(hashes, faces, period=None) :
+    '''
+    Pick "faces" evenly spaced images from one turn. The images are
+    assumed to be at evenly spaced angles, so the index nearest each
+    wanted angle is used. Nothing is measured per image.
+
+    Period is the number of images in one turn, from findperiod
+    if not given.
+
+    Returns list of image indices, in angle order.
+    '''
+    if period is None :
+        period = findperiod(hashes)
+    if faces > period :
+        raise ValueError("Only %d images in one turn, need %d" % (period, faces))
+    return [int(round(k * period / faces)) % period for k in range(faces)]
+
+#   Unit test
+
+def unittest() :
+    import math
+    import random
+    def smoothturn(cnt, period, fold=1) :
+        '''
+        Synthetic hashes for a steady turn, "period" images per turn,
+        of an object with "fold"-fold rotational symmetry.
+        Neighbors differ in a few bits, images one turn apart are equal.
+        '''
+        rng = random.Random(1)
+        phases = [rng.uniform(0, 2*math.pi) for _ in range(256)]
+        freqs = [fold * rng.choice((1, 2, 3)) for _ in range(256)]    # one turn is a whole number of cycles
+        hashes = []
+        for i in range(cnt) :
+            bits = 0
+            for (phase, freq) in zip(phases, freqs) :
+                bits = (bits << 1) | (1 if math.sin(2*math.pi*freq*i/period + phase) > 0 else 0)
+            hashes.append(bits)
+        return hashes
+    def noisy(hashes, flips) :
+        rng = random.Random(2)
+        return [h ^ sum([1 << rng.randrange(256) for _ in range(flips)]) for h in hashes]
+    assert findperiod(smoothturn(36, 36)) == 36             # exactly one turn
+    assert findperiod(smoothturn(40, 36)) == 36             # overshoot by 4
+    assert findperiod(smoothturn(45, 36)) == 36             # overshoot by 9
+    assert findperiod(noisy(smoothturn(44, 36), 2)) == 36   # overshoot, with noise
+    assert findperiod(smoothturn(38, 36)) == 38             # too few pairs to be sure of the wrap
+    assert findperiod([5, 5]) == 2                          # too few to look
+    for fold in (2, 4, 6, 8) :                              # symmetric object, exactly one turn
+        assert findperiod(smoothturn(72, 72, fold)) == 72, fold
+    assert findperiod(smoothturn(80, 72, 4)) == 80          # overshoot cannot be told from symmetry
+    assert selectviews(smoothturn(72, 72, 4), 8) == [0, 9, 18, 27, 36, 45, 54, 63]
+    assert selectviews(smoothturn(40, 36), 8) == [0, 4, 9, 14, 18, 22, 27, 32]
+    try :
+        selectviews(smoothturn(6, 6), 8)
+        assert False, "selectviews should have failed"
+    except ValueError :
+        pass
+    print("Test complete.")
+
+
+if __name__ == "__main__" :                             # if running standalone
+    unittest()
@@ -0,0 +1,136 @@
+#
+#   watchfolder.py - part of impostormaker
+#
+#   Watch a capture directory and keep the impostor up to date
+#
+#   Screenshots are dropped into the directory one angle at a time.
+#   Each new or changed image is extracted once, and its size and
+#   bounding box are kept, so the uniform crop can be recomputed from
+#   that information alone. After each change the impostor image is
+#   regenerated and saved.
+#
+#   The directory is polled. A file is used once its size and
+#   modification time are the same on two polls in a row, so that
+#   partly written files are not read.
+#
+#   Only the area inside the frame of each view is kept in memory.
+#   Extracting a new image is the slow part, about two seconds for
+#   a 1856x1028 screenshot, mostly finding the frame. Regenerating
+#   the impostor from views already extracted is much faster.
+#
+import os
+import time
+import impostorfile
+
+#   Useful constants
+INPUTEXTENSIONS = (".jpg", ".jpeg", ".png")         # files to use as input
+OUTPUTPREFIX = "impostor-"                          # our own output files, not input
+
+class WatchFolder :
+
+    '''
+    Watch a directory and regenerate the impostor when its images change
+    '''
+
+    def __init__(self, impostor, dirname, imagesize, pollinterval=0.25) :
+        self.impostor = impostor                        # parent object, does the crop and output
+        self.dirname = dirname                          # directory to watch
+        self.imagesize = imagesize                      # size of each image in the output
+        self.pollinterval = pollinterval                # seconds between polls
+        self.pending = {}                               # filename -> (mtime, size), waiting to settle
+        self.done = {}                                  # filename -> (mtime, size), already extracted
+        self.views = {}                                 # filename -> ImpostorFile, extracted OK
+
+    def scan(self) :
+        '''
+        Return dict of filename -> (mtime, size) for input files in the directory
+        '''
+        files = {}
+        with os.scandir(self.dirname) as entries :
+            for entry in entries :
+                if not entry.is_file() or entry.name.startswith(OUTPUTPREFIX) :
+                    continue
+                if not entry.name.lower().endswith(INPUTEXTENSIONS) :
+                    continue
+                st = entry.stat()
+                files[entry.path] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def update(self) :
+        '''
+        One polling pass. Extract new and changed images, forget deleted ones.
+
+        Returns true if the set of views changed.
+        '''
+        current = self.scan()
+        changed = False
+        for name in list(self.done) :                   # deleted files
+            if name not in current :
+                del self.done[name]
+                if self.views.pop(name, None) is not None :
+                    changed = True
+        for name in list(self.pending) :
+            if name not in current :
+                del self.pending[name]
+        for (name, stat) in sorted(current.items()) :
+            if self.done.get(name) == stat :            # already extracted, no change
+                continue
+            if self.pending.get(name) != stat :         # new, or still being written
+                self.pending[name] = stat
+                continue
+            del self.pending[name]                      # settled, use it
+            self.done[name] = stat
+            print("Extracting ", name)
+            ifile = impostorfile.ImpostorFile(self.impostor, name)
+            try :
+                ifile.readimage()
+            except (IOError, ValueError) as err :       # not a usable image
+                print("Cannot read ", name, ": ", err)
+                ifile = None
+            if ifile is not None and ifile.extract() :
+                ifile.setextracted(ifile.inputrgb.crop(ifile.framerect), ifile.croppedbbox)   # drop full-size input
+                self.views[name] = ifile
+                changed = True
+            elif self.views.pop(name, None) is not None : # was good, now bad
+                changed = True
+        return changed
+
+    def outname(self) :
+        '''
+        Output name, without extension. Named after the directory, so it
+        stays the same as images come and go.
+        '''
+        return os.path.join(self.dirname, OUTPUTPREFIX + os.path.basename(os.path.normpath(self.dirname)))
+
+    def regenerate(self) :
+        '''
+        Recompute the uniform crop from the views already extracted,
+        and generate and save the impostor image.
+
+        Returns true if success
+        '''
+        names = sorted(self.views)
+        if len(names) == 0 :
+            return False
+        self.impostor.filenames = names
+        self.impostor.impostorfiles = [self.views[name] for name in names]
+        if not self.impostor.uniformcrop() :
+            print("Uniform crop failed. Sizes of images inside frame vary too much.")
+            return False
+        finalimage = self.impostor.generateimpostor(self.imagesize)
+        outfile = self.impostor.outfilename(self.outname())
+        tmpfile = outfile + ".tmp"
+        finalimage.save(tmpfile, format="PNG")          # write, then rename, so readers never see a partial file
+        os.replace(tmpfile, outfile)
+        print("Updated ", outfile, " from ", len(names), " images.")
+        return True
+
+    def run(self) :
+        '''
+        Watch until interrupted.
+        '''
+        print("Watching ", self.dirname)
+        while True :
+            if self.update() :
+                self.regenerate()
+            time.sleep(self.pollinterval)